@@ -2,7 +2,9 @@ import argparse
 import asyncio
 import logging
 import os
+from contextlib import AsyncExitStack
 
+import uvloop
 from aiohttp import web
 
 from .client import Client
@@ -26,6 +28,7 @@ async def main():
     parser.add_argument("--max-ad-history", type=int, default=50)
     parser.add_argument("--session-expiration", type=int, default=60 * 60 * 24 * 120)
     parser.add_argument("--use-firefox", action="store_true")
+    parser.add_argument("--query-workers", type=int, default=1)
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int, default=8080)
     args = parser.parse_args()
@@ -33,30 +36,41 @@ async def main():
     logging.basicConfig(level=logging.INFO)
 
     async with DB.connect(args.db) as db:
-        async with Client.create(use_firefox=args.use_firefox) as client:
-            server = Server(
-                asset_dir=args.asset_dir,
-                db=db,
-                client=client,
-                notifier=Notifier(vapid_sub=args.vapid_sub),
-                max_message_retries=args.max_message_retries,
-                message_retry_interval=args.message_retry_interval,
-                refresh_interval=args.refresh_interval,
-                ad_text_expiration=args.ad_text_expiration,
-                min_notify_interval=args.min_notify_interval,
-                max_ad_history=args.max_ad_history,
-                session_expiration=args.session_expiration,
-            )
-            app = web.Application()
-            server.add_routes(app.router)
-
-            # https://stackoverflow.com/questions/53465862/python-aiohttp-into-existing-event-loop
-            runner = web.AppRunner(app)
-            await runner.setup()
-            site = web.TCPSite(runner, host=args.host, port=args.port)
-            await site.start()
-            await asyncio.Event().wait()
+        async with AsyncExitStack() as stack:
+            clients = [
+                await stack.enter_async_context(
+                    Client.create(use_firefox=args.use_firefox)
+                )
+                for _ in range(args.query_workers)
+            ]
+            async with Notifier.create(vapid_sub=args.vapid_sub) as notifier:
+                server = Server(
+                    asset_dir=args.asset_dir,
+                    db=db,
+                    clients=clients,
+                    notifier=notifier,
+                    max_message_retries=args.max_message_retries,
+                    message_retry_interval=args.message_retry_interval,
+                    refresh_interval=args.refresh_interval,
+                    ad_text_expiration=args.ad_text_expiration,
+                    min_notify_interval=args.min_notify_interval,
+                    max_ad_history=args.max_ad_history,
+                    session_expiration=args.session_expiration,
+                )
+                app = web.Application()
+                server.add_routes(app.router)
+
+                # https://stackoverflow.com/questions/53465862/python-aiohttp-into-existing-event-loop
+                runner = web.AppRunner(app)
+                await runner.setup()
+                site = web.TCPSite(runner, host=args.host, port=args.port)
+                await site.start()
+                try:
+                    await asyncio.Event().wait()
+                finally:
+                    await runner.cleanup()
+                    await server.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
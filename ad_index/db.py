@@ -1,10 +1,10 @@
 import asyncio
 import hashlib
-import json
 import sqlite3
+import time
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache
 from typing import (
     Any,
     Awaitable,
@@ -14,89 +14,117 @@ from typing import (
     Optional,
     Sequence,
     Set,
+    Tuple,
     TypeVar,
-    Union,
 )
 
 import aiosqlite
-from jsonschema import validate
+import orjson
+from jsonschema import Draft7Validator
 
 R = TypeVar("R")
 
 MAX_NOTIFY_CHARS = 128  # don't send big push notifications
 
+# Kept as constants so that both variants hit sqlite3's statement cache
+# without rebuilding the SQL text on every call.
+_AD_QUERIES_SQL = """
+SELECT ad_queries.ad_query_id, nickname, query, filters, client_subs.client_id
+FROM ad_queries
+LEFT JOIN client_subs ON (
+    client_subs.ad_query_id = ad_queries.ad_query_id
+    AND client_subs.client_id = (
+        SELECT client_id FROM clients WHERE clients.session_hash = ?
+    )
+)
+"""
+_AD_QUERY_BY_ID_SQL = _AD_QUERIES_SQL + "WHERE ad_queries.ad_query_id = ?\n"
+
+# Compiled once, since filters are validated for every ad query row loaded.
+AD_QUERY_FILTERS_VALIDATOR = Draft7Validator(
+    {
+        "type": "object",
+        "properties": {
+            "matchTerms": {
+                "anyOf": [
+                    {"type": "null"},
+                    {"type": "array", "items": {"type": "string"}},
+                ],
+            },
+            "rejectTerms": {
+                "anyOf": [
+                    {"type": "null"},
+                    {"type": "array", "items": {"type": "string"}},
+                ],
+            },
+            "accountFilter": {"anyOf": [{"type": "null"}, {"type": "string"}]},
+        },
+    }
+)
+
 
 class DataArgumentError(Exception):
     pass
 
 
-@dataclass
+# Frozen, since parse_filters() shares instances between callers.
+@dataclass(slots=True, frozen=True)
 class AdQueryFilters:
-    match_terms: Optional[List[str]] = None
-    reject_terms: Optional[List[str]] = None
+    match_terms: Optional[Tuple[str, ...]] = None
+    reject_terms: Optional[Tuple[str, ...]] = None
     account_filter: Optional[str] = None
 
     def should_keep(self, content: str, account_name: str) -> bool:
-        content = content.lower()
-        if self.match_terms:
-            if not any(x.lower() in content for x in self.match_terms):
+        return self.compile()(content, account_name)
+
+    def compile(self) -> Callable[[str, str], bool]:
+        # Lowercase the terms once when filtering many results.
+        match_terms = tuple(x.lower() for x in self.match_terms or ())
+        reject_terms = tuple(x.lower() for x in self.reject_terms or ())
+        account_filter = (self.account_filter or "").lower()
+
+        def should_keep(content: str, account_name: str) -> bool:
+            content = content.lower()
+            if match_terms and not any(x in content for x in match_terms):
                 return False
-        if self.reject_terms:
-            if any(x.lower() in content for x in self.reject_terms):
+            if any(x in content for x in reject_terms):
                 return False
-        if self.account_filter:
-            if self.account_filter.lower() not in account_name.lower():
+            if account_filter and account_filter not in account_name.lower():
                 return False
-        return True
+            return True
+
+        return should_keep
 
     def to_json(self) -> Dict[str, Any]:
         return dict(
-            matchTerms=self.match_terms,
-            rejectTerms=self.reject_terms,
+            matchTerms=optional_list(self.match_terms),
+            rejectTerms=optional_list(self.reject_terms),
             accountFilter=self.account_filter,
         )
 
     @classmethod
     def from_json(cls, doc: Any) -> "AdQueryFilters":
-        schema = {
-            "type": "object",
-            "properties": {
-                "matchTerms": {
-                    "anyOf": [
-                        {"type": "null"},
-                        {"type": "array", "items": {"type": "string"}},
-                    ],
-                },
-                "rejectTerms": {
-                    "anyOf": [
-                        {"type": "null"},
-                        {"type": "array", "items": {"type": "string"}},
-                    ],
-                },
-                "accountFilter": {"anyOf": [{"type": "null"}, {"type": "string"}]},
-            },
-        }
-        validate(instance=doc, schema=schema)
+        AD_QUERY_FILTERS_VALIDATOR.validate(doc)
         return cls(
-            match_terms=doc.get("matchTerms"),
-            reject_terms=doc.get("rejectTerms"),
+            match_terms=optional_tuple(doc.get("matchTerms")),
+            reject_terms=optional_tuple(doc.get("rejectTerms")),
             account_filter=doc.get("accountFilter"),
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class AdQueryBase:
     nickname: str
     query: str
     filters: AdQueryFilters
 
 
-@dataclass
+@dataclass(slots=True)
 class AdQuery(AdQueryBase):
     ad_query_id: int
 
 
-@dataclass
+@dataclass(slots=True)
 class AdQueryResult(AdQuery):
     subscribed: bool
 
@@ -110,13 +138,13 @@ class AdQueryResult(AdQuery):
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class ClientPushInfo:
     push_sub: Optional[str]
     vapid_priv: str
 
 
-@dataclass
+@dataclass(slots=True)
 class PushQueueItem:
     id: int
     client_id: int
@@ -125,7 +153,7 @@ class PushQueueItem:
     retries: int
 
 
-@dataclass
+@dataclass(slots=True)
 class AdContent:
     ad_query_id: int
     id: str
@@ -147,7 +175,7 @@ class AdContent:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class AdQueryStatus(AdQueryResult):
     next_pull: int
     last_pull: Optional[int]
@@ -155,7 +183,8 @@ class AdQueryStatus(AdQueryResult):
     last_notify: Optional[int]
 
     def to_json(self) -> Dict[str, Any]:
-        res = super().to_json()
+        # Zero-argument super() doesn't work in slotted dataclasses.
+        res = AdQueryResult.to_json(self)
         res.update(
             dict(
                 nextPull=self.next_pull,
@@ -170,13 +199,15 @@ class AdQueryStatus(AdQueryResult):
 def transaction(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
     async def new_fn(db: "DB", *args, **kwargs) -> Any:
         async with db._lock:
-            await db._retry(partial(db._conn.execute, "BEGIN TRANSACTION"))
+            # Take the write lock up front so that statements inside the
+            # transaction never have to upgrade from a shared lock.
+            await db._retry(db._conn.execute, "BEGIN IMMEDIATE")
             try:
-                result = await db._retry(partial(fn, db, *args, **kwargs))
+                result = await fn(db, *args, **kwargs)
             except:
-                await db._retry(partial(db._conn.execute, "ROLLBACK"))
+                await db._conn.execute("ROLLBACK")
                 raise
-            await db._retry(partial(db._conn.execute, "COMMIT"))
+            await db._retry(db._conn.execute, "COMMIT")
             return result
 
     return new_fn
@@ -187,10 +218,14 @@ class DB:
         self._conn = conn
         self._lock = asyncio.Lock()
 
+        # Set whenever new items are added to the push queue.
+        self.push_queue_event = asyncio.Event()
+
     @classmethod
     @asynccontextmanager
     async def connect(cls, path: str) -> "DB":
-        async with aiosqlite.connect(path) as conn:
+        # Transactions are managed explicitly by @transaction.
+        async with aiosqlite.connect(path, isolation_level=None) as conn:
             db = cls(conn)
             await db._conn.execute("PRAGMA foreign_keys = ON")
             await db._create_tables()
@@ -219,7 +254,6 @@ class DB:
                 client_id     INTEGER   PRIMARY KEY AUTOINCREMENT,
                 vapid_pub     BLOB      NOT NULL,
                 vapid_priv    BLOB      NOT NULL,
-                session_id    CHAR(64)  NOT NULL,
                 session_hash  CHAR(64)  NOT NULL,
                 push_sub      TEXT,
                 last_seen     INTEGER   NOT NULL,
@@ -227,6 +261,10 @@ class DB:
             )
             """
         )
+        # Older databases also stored the plaintext session_id.
+        client_columns = await self._conn.execute_fetchall("PRAGMA table_info(clients)")
+        if any(row[1] == "session_id" for row in client_columns):
+            await self._conn.execute("ALTER TABLE clients DROP COLUMN session_id")
         await self._conn.execute(
             """
             CREATE TABLE IF NOT EXISTS client_subs (
@@ -294,48 +332,57 @@ class DB:
     async def ad_queries(
         self, session_id: str, ad_query_id: Optional[int] = None
     ) -> List[AdQueryResult]:
-        hash = hash_session_id(session_id)
-        cursor = await self._conn.execute(
-            f"""
-            SELECT ad_queries.ad_query_id, nickname, query, filters, client_subs.client_id
-            FROM ad_queries
-            LEFT JOIN client_subs ON (
-                client_subs.ad_query_id = ad_queries.ad_query_id
-                AND client_subs.client_id = (
-                    SELECT client_id FROM clients WHERE clients.session_hash = ?
-                )
+        hash = session_hash(session_id)
+        if ad_query_id is None:
+            rows = await self._conn.execute_fetchall(_AD_QUERIES_SQL, (hash,))
+        else:
+            rows = await self._conn.execute_fetchall(
+                _AD_QUERY_BY_ID_SQL, (hash, ad_query_id)
             )
-            {f'WHERE ad_queries.ad_query_id = ?' if ad_query_id is not None else ''}
-            """,
-            (hash, *([ad_query_id] if ad_query_id is not None else [])),
-        )
-        results = []
-        async for row in cursor:
-            results.append(
-                AdQueryResult(
+        return [
+            AdQueryResult(
+                nickname=row[1],
+                query=row[2],
+                filters=parse_filters(row[3]),
+                ad_query_id=str(row[0]),
+                subscribed=row[4] is not None,
+            )
+            for row in rows
+        ]
+
+    @transaction
+    async def ad_queries_json(self, session_id: str) -> bytes:
+        # Serialize rows straight to JSON, matching AdQueryResult.to_json().
+        # Stored filters always come from AdQueryFilters.to_json(), so they
+        # can be embedded without parsing them.
+        hash = session_hash(session_id)
+        rows = await self._conn.execute_fetchall(_AD_QUERIES_SQL, (hash,))
+        return orjson.dumps(
+            [
+                dict(
+                    adQueryId=str(row[0]),
                     nickname=row[1],
                     query=row[2],
-                    filters=AdQueryFilters.from_json(json.loads(row[3])),
-                    ad_query_id=str(row[0]),
+                    filters=orjson.Fragment(row[3]),
                     subscribed=row[4] is not None,
                 )
-            )
-        return results
+                for row in rows
+            ]
+        )
 
     @transaction
     async def insert_ad_query(
         self, q: AdQueryBase, sub_session_id: Optional[str] = None
     ) -> Optional[int]:
         if sub_session_id:
-            hash = hash_session_id(sub_session_id)
-            client_id = None
-            async for row in await self._conn.execute(
+            hash = session_hash(sub_session_id)
+            cursor = await self._conn.execute(
                 "SELECT client_id FROM clients WHERE session_hash=?", (hash,)
-            ):
-                (client_id,) = row
-                break
-            if client_id is None:
+            )
+            row = await cursor.fetchone()
+            if row is None:
                 return None
+            (client_id,) = row
         result = await self._conn.execute_insert(
             """
             INSERT INTO ad_queries (
@@ -345,7 +392,7 @@ class DB:
                 next_pull
             ) VALUES (?, ?, ?, STRFTIME('%s'))
             """,
-            (q.nickname, q.query, json.dumps(q.filters.to_json())),
+            (q.nickname, q.query, orjson.dumps(q.filters.to_json()).decode()),
         )
         (id,) = result
         if sub_session_id:
@@ -359,37 +406,65 @@ class DB:
     async def update_ad_query(
         self, q: AdQueryResult, session_id: str
     ) -> Dict[str, Any]:
+        cursor = await self._conn.execute(
+            "SELECT query, filters FROM ad_queries WHERE ad_query_id=?",
+            (q.ad_query_id,),
+        )
+        row = await cursor.fetchone()
+        # Renames are common, and don't need the full update below.
+        if (
+            row is not None
+            and row[0] == q.query
+            and parse_filters(row[1]) == q.filters
+        ):
+            updated_data = await self._update_ad_query_nickname(
+                q.ad_query_id, q.nickname
+            )
+        else:
+            updated_data = await self._update_ad_query_data(q)
+        updated_sub = await self._toggle_ad_query_subscription(
+            q.ad_query_id, session_id, q.subscribed
+        )
+        return dict(updated_data=updated_data, updated_sub=updated_sub)
+
+    async def _update_ad_query_data(self, q: AdQueryResult) -> bool:
         try:
-            updated_data = (
+            cursor = await self._conn.execute(
+                """
+                UPDATE ad_queries SET
+                    nickname=?,
+                    query=?,
+                    filters=?,
+                    next_pull=STRFTIME('%s'),
+                    last_notify=NULL
+                WHERE ad_query_id=?
+                """,
                 (
-                    await self._conn.execute(
-                        """
-                        UPDATE ad_queries SET
-                            nickname=?,
-                            query=?,
-                            filters=?,
-                            next_pull=STRFTIME('%s'),
-                            last_notify=NULL
-                        WHERE ad_query_id=?
-                        """,
-                        (
-                            q.nickname,
-                            q.query,
-                            json.dumps(q.filters.to_json()),
-                            q.ad_query_id,
-                        ),
-                    )
-                ).rowcount
-                != 0
+                    q.nickname,
+                    q.query,
+                    orjson.dumps(q.filters.to_json()).decode(),
+                    q.ad_query_id,
+                ),
             )
         except sqlite3.IntegrityError as exc:
             if "UNIQUE" in str(exc):
                 raise DataArgumentError("name is already in use")
             raise
-        updated_sub = await self._toggle_ad_query_subscription(
-            q.ad_query_id, session_id, q.subscribed
-        )
-        return dict(updated_data=updated_data, updated_sub=updated_sub)
+        return cursor.rowcount != 0
+
+    async def _update_ad_query_nickname(self, ad_query_id: int, nickname: str) -> bool:
+        # Unlike _update_ad_query_data(), this doesn't re-encode the filters
+        # or schedule a new pull.
+        try:
+            cursor = await self._conn.execute(
+                "UPDATE ad_queries SET nickname=? WHERE ad_query_id=?",
+                (nickname, ad_query_id),
+            )
+        except sqlite3.IntegrityError as exc:
+            if "UNIQUE" in str(exc):
+                raise DataArgumentError("name is already in use")
+            raise
+        return cursor.rowcount != 0
 
     @transaction
     async def ad_query_next(self, refresh_interval: int) -> Optional[AdQuery]:
@@ -402,9 +477,7 @@ class DB:
             LIMIT 1
             """,
         )
-        row = None
-        async for row in cursor:
-            break
+        row = await cursor.fetchone()
         if row is None:
             return None
         id, nickname, query, filters = row
@@ -415,7 +488,7 @@ class DB:
         return AdQuery(
             nickname=nickname,
             query=query,
-            filters=AdQueryFilters.from_json(json.loads(filters)),
+            filters=parse_filters(filters),
             ad_query_id=id,
         )
 
@@ -434,7 +507,7 @@ class DB:
     async def ad_query_status(
         self, session_id: str, ad_query_id: int
     ) -> Optional[AdQueryStatus]:
-        hash = hash_session_id(session_id)
+        hash = session_hash(session_id)
         rows = await self._conn.execute_fetchall(
             """
             SELECT
@@ -474,7 +547,7 @@ class DB:
         return AdQueryStatus(
             nickname=nickname,
             query=query,
-            filters=AdQueryFilters.from_json(json.loads(filters)),
+            filters=parse_filters(filters),
             ad_query_id=ad_query_id,
             subscribed=bool(subscribed),
             next_pull=next_pull,
@@ -494,7 +567,7 @@ class DB:
     async def _toggle_ad_query_subscription(
         self, ad_query_id: int, session_id: str, subscribed: bool
     ) -> bool:
-        hash = hash_session_id(session_id)
+        hash = session_hash(session_id)
         client_id = None
         async for row in await self._conn.execute(
             "SELECT client_id FROM clients WHERE session_hash=?", (hash,)
@@ -533,18 +606,18 @@ class DB:
     async def create_session(
         self, vapid_pub: bytes, vapid_priv: bytes, session_id: str
     ):
-        hash = hash_session_id(session_id)
+        hash = session_hash(session_id)
         await self._conn.execute(
             """
-            INSERT INTO clients (vapid_pub, vapid_priv, session_id, session_hash, last_seen)
-            VALUES (?, ?, ?, ?, STRFTIME('%s'))
+            INSERT INTO clients (vapid_pub, vapid_priv, session_hash, last_seen)
+            VALUES (?, ?, ?, STRFTIME('%s'))
             """,
-            (vapid_pub, vapid_priv, session_id, hash),
+            (vapid_pub, vapid_priv, hash),
         )
 
     @transaction
     async def session_exists(self, session_id: str) -> bool:
-        hash = hash_session_id(session_id)
+        hash = session_hash(session_id)
         count = await self._fetchone(
             "SELECT COUNT(*) FROM clients WHERE session_hash=?", (hash,)
         )
@@ -563,10 +636,9 @@ class DB:
     async def update_client_push_sub(
         self, session_id: str, push_sub: Optional[str]
     ) -> bool:
-        if json.loads(push_sub) is None:
-            # Store NULL as sql type and not JSON string.
-            push_sub = None
-        hash = hash_session_id(session_id)
+        # Callers pass None rather than a JSON "null", so that we store NULL
+        # as an sql type without parsing push_sub again here.
+        hash = session_hash(session_id)
         c1 = self._conn.total_changes
         await self._conn.execute(
             "UPDATE clients SET push_sub=?, last_seen=STRFTIME('%s') WHERE session_hash=?",
@@ -585,8 +657,11 @@ class DB:
         return count != 0
 
     @transaction
-    async def push_queue_next(self, retry_timeout: int) -> Optional[PushQueueItem]:
-        cursor = await self._conn.execute(
+    async def push_queue_next_batch(
+        self, retry_timeout: int, limit: int
+    ) -> List[PushQueueItem]:
+        now = int(time.time())
+        rows = await self._conn.execute_fetchall(
             """
             SELECT
                 push_queue.id,
@@ -597,51 +672,68 @@ class DB:
                 clients.vapid_priv
             FROM push_queue
             LEFT JOIN clients ON clients.client_id = push_queue.client_id
-            WHERE retry_time <= CAST(STRFTIME('%s') AS INTEGER)
+            WHERE retry_time <= ?
             ORDER BY retry_time
+            LIMIT ?
             """,
+            (now, limit),
         )
-        row = None
-        async for row in cursor:
-            break
-        if row is None:
-            return None
-        id, client_id, message, retries, push_sub, vapid_priv = row
-        await self._conn.execute(
-            "UPDATE push_queue SET retry_time=STRFTIME('%s')+?, retries=? WHERE id=?",
-            (retry_timeout, retries + 1, id),
-        )
-        return PushQueueItem(
-            id=id,
-            client_id=client_id,
-            push_info=ClientPushInfo(push_sub=push_sub, vapid_priv=vapid_priv),
-            message=message,
-            retries=retries,
+        await self._conn.executemany(
+            "UPDATE push_queue SET retry_time=?, retries=retries+1 WHERE id=?",
+            [(now + retry_timeout, row[0]) for row in rows],
         )
+        return [
+            PushQueueItem(
+                id=id,
+                client_id=client_id,
+                push_info=ClientPushInfo(push_sub=push_sub, vapid_priv=vapid_priv),
+                message=message,
+                retries=retries,
+            )
+            for id, client_id, message, retries, push_sub, vapid_priv in rows
+        ]
 
     @transaction
-    async def push_queue_finish(self, id: int, unsub_client: bool = False):
-        if unsub_client:
-            await self._conn.execute(
-                """
-                UPDATE clients SET push_sub=NULL WHERE client_id=(
-                    SELECT client_id FROM push_queue WHERE id=?
-                )
-                """,
-                (id,),
+    async def push_queue_next_retry_time(self) -> Optional[int]:
+        cursor = await self._conn.execute("SELECT MIN(retry_time) FROM push_queue")
+        (retry_time,) = await cursor.fetchone()
+        return retry_time
+
+    @transaction
+    async def push_queue_finish_batch(self, results: Sequence[Tuple[int, bool]]):
+        # Each statement covers the whole batch, passing ids as a JSON array.
+        await self._conn.execute(
+            """
+            UPDATE clients SET push_sub=NULL WHERE client_id IN (
+                SELECT client_id FROM push_queue
+                WHERE id IN (SELECT value FROM json_each(?))
             )
-        else:
-            # If the client successfully received a notification, we don't want
-            # to expire the client session.
-            await self._conn.execute(
-                """
-                UPDATE clients SET last_seen=STRFTIME('%s') WHERE client_id=(
-                    SELECT client_id FROM push_queue WHERE id=?
-                )
-                """,
-                (id,),
+            """,
+            (
+                orjson.dumps(
+                    [id for id, unsub_client in results if unsub_client]
+                ).decode(),
+            ),
+        )
+        # If the client successfully received a notification, we don't want
+        # to expire the client session.
+        await self._conn.execute(
+            """
+            UPDATE clients SET last_seen=STRFTIME('%s') WHERE client_id IN (
+                SELECT client_id FROM push_queue
+                WHERE id IN (SELECT value FROM json_each(?))
             )
-        await self._conn.execute("DELETE FROM push_queue WHERE id=?", (id,))
+            """,
+            (
+                orjson.dumps(
+                    [id for id, unsub_client in results if not unsub_client]
+                ).decode(),
+            ),
+        )
+        await self._conn.execute(
+            "DELETE FROM push_queue WHERE id IN (SELECT value FROM json_each(?))",
+            (orjson.dumps([id for id, _ in results]).decode(),),
+        )
 
     @transaction
     async def unseen_ad_ids(self, ad_query_id: int, ids: Sequence[str]) -> Set[str]:
@@ -650,7 +742,7 @@ class DB:
             SELECT id FROM ad_content
             WHERE ad_query_id=? AND id IN (SELECT value FROM json_each(?))
             """,
-            (ad_query_id, json.dumps(list(ids))),
+            (ad_query_id, orjson.dumps(list(ids)).decode()),
         )
         seen = set()
         async for row in cursor:
@@ -658,27 +750,52 @@ class DB:
         return set(x for x in ids if x not in seen)
 
     @transaction
-    async def insert_ad(
+    async def insert_ads_batch(
         self,
         ad_query_id: int,
-        id: str,
-        account_name: str,
-        account_url: str,
-        start_date: int,
-        text: str,
-        screenshot: bytes,
+        ads: Sequence[Tuple[str, str, str, int, str, bytes]],
         text_expiration: int,
         min_notify_interval: int,
-    ) -> bool:
+    ) -> int:
+        # Each ad is (id, account_name, account_url, start_date, text, screenshot).
         queries = await self._conn.execute_fetchall(
             "SELECT nickname FROM ad_queries WHERE ad_query_id=?",
             (ad_query_id,),
         )
         if not len(queries):
-            return False
+            return 0
         nickname = queries[0][0]
+        count = 0
+        for id, account_name, account_url, start_date, text, screenshot in ads:
+            if await self._insert_ad(
+                ad_query_id=ad_query_id,
+                nickname=nickname,
+                id=id,
+                account_name=account_name,
+                account_url=account_url,
+                start_date=start_date,
+                text=text,
+                screenshot=screenshot,
+                text_expiration=text_expiration,
+                min_notify_interval=min_notify_interval,
+            ):
+                count += 1
+        return count
 
-        text_hash = hash_session_id(text.lower())
+    async def _insert_ad(
+        self,
+        ad_query_id: int,
+        nickname: str,
+        id: str,
+        account_name: str,
+        account_url: str,
+        start_date: int,
+        text: str,
+        screenshot: bytes,
+        text_expiration: int,
+        min_notify_interval: int,
+    ) -> bool:
+        text_hash = hash_session_id(text.lower().encode())
         inserted = await self._conn.execute_insert(
             """
             INSERT OR REPLACE INTO ad_content (
@@ -734,7 +851,7 @@ class DB:
             (min_notify_interval, ad_query_id),
         )
         if not count and should_notify:
-            notify_message = json.dumps(
+            notify_message = orjson.dumps(
                 dict(
                     adQueryId=ad_query_id,
                     nickname=nickname,
@@ -745,8 +862,8 @@ class DB:
                         text=text[:MAX_NOTIFY_CHARS],
                     ),
                 )
-            )
-            await self._conn.execute(
+            ).decode()
+            cursor = await self._conn.execute(
                 """
                 INSERT INTO push_queue (client_id, message, retry_time, retries)
                 SELECT client_id, ?, STRFTIME('%s'), 0
@@ -758,6 +875,8 @@ class DB:
                 """,
                 (notify_message, ad_query_id),
             )
+            if cursor.rowcount:
+                self.push_queue_event.set()
             await self._conn.execute(
                 """
                 UPDATE ad_queries SET last_notify=STRFTIME('%s') WHERE ad_query_id=?
@@ -836,7 +955,7 @@ class DB:
             "SELECT COUNT(*) FROM ad_queries WHERE ad_query_id=?", (ad_query_id,)
         ) == (0,):
             raise DataArgumentError(f"no ad_query_id found: {ad_query_id}")
-        cursor = await self._conn.execute(
+        rows = await self._conn.execute_fetchall(
             """
             SELECT ad_query_id, id, account_name, account_url, start_date, last_seen, text
             FROM ad_content
@@ -845,20 +964,18 @@ class DB:
             """,
             (ad_query_id,),
         )
-        results = []
-        async for row in cursor:
-            results.append(
-                AdContent(
-                    ad_query_id=row[0],
-                    id=row[1],
-                    account_name=row[2],
-                    account_url=row[3],
-                    start_date=row[4],
-                    last_seen=row[5],
-                    text=row[6],
-                )
+        return [
+            AdContent(
+                ad_query_id=row[0],
+                id=row[1],
+                account_name=row[2],
+                account_url=row[3],
+                start_date=row[4],
+                last_seen=row[5],
+                text=row[6],
             )
-        return results
+            for row in rows
+        ]
 
     async def ad_content_screenshot(
         self, ad_query_id: int, ad_id: str
@@ -877,10 +994,10 @@ class DB:
             raise sqlite3.OperationalError(f"expected 1 result but got {len(results)}")
         return results[0]
 
-    async def _retry(self, fn: Callable[[], Awaitable[R]]) -> R:
+    async def _retry(self, fn: Callable[..., Awaitable[R]], *args, **kwargs) -> R:
         while True:
             try:
-                return await fn()
+                return await fn(*args, **kwargs)
             except sqlite3.OperationalError as exc:
                 if "database is locked" in str(exc):
                     await asyncio.sleep(0.01)
@@ -888,15 +1005,37 @@ class DB:
                     raise
 
 
-def hash_session_id(session_id: Union[str, bytes]) -> str:
-    h = hashlib.new("sha256")
-    h.update(bytes(session_id, "utf-8") if isinstance(session_id, str) else session_id)
-    return h.hexdigest()
+def hash_session_id(data: bytes) -> str:
+    # The named constructor binds straight to OpenSSL's SHA-256, which uses
+    # the CPU's SHA extensions where available; hashlib.new() has to look
+    # the algorithm up by name on every call.
+    return hashlib.sha256(data).hexdigest()
+
+
+def session_hash(session_id: str) -> str:
+    # Server handlers reject malformed ids; UTF-8 keeps any other caller's
+    # unknown id a plain "not found" rather than an encoding error.
+    return hash_session_id(session_id.encode("utf-8"))
+
+
+@lru_cache(maxsize=1024)
+def parse_filters(data: str) -> AdQueryFilters:
+    # Many ad queries share the same filters, so skip parsing and validating
+    # repeats.
+    return AdQueryFilters.from_json(orjson.loads(data))
+
+
+def optional_tuple(items: Optional[List[str]]) -> Optional[Tuple[str, ...]]:
+    return None if items is None else tuple(items)
+
+
+def optional_list(items: Optional[Tuple[str, ...]]) -> Optional[List[str]]:
+    return None if items is None else list(items)
 
 
 async def main():
     async with DB.connect("test.db") as db:
-        await db.push_queue_finish(0, True)
+        await db.push_queue_finish_batch([(0, True)])
 
 
 if __name__ == "__main__":
@@ -1,33 +1,78 @@
-import asyncio
-import json
-from concurrent.futures import ThreadPoolExecutor
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Dict
+from urllib.parse import urlparse
 
-import requests
+import aiohttp
+import orjson
 from py_vapid import Vapid
-from pywebpush import webpush
+from pywebpush import WebPusher
 
 from .db import ClientPushInfo
 
+# Signed VAPID tokens are reused for one window, and remain valid for
+# between one and two windows after they are first used.
+VAPID_WINDOW = 6 * 60 * 60
+
 
 class Notifier:
-    def __init__(self, vapid_sub: str):
+    def __init__(self, vapid_sub: str, session: aiohttp.ClientSession):
         self.vapid_sub = vapid_sub
-        self.executor = ThreadPoolExecutor(1)
-        self.session = requests.Session()
+        self.session = session
+
+    @classmethod
+    @asynccontextmanager
+    async def create(cls, vapid_sub: str) -> "Notifier":
+        # Pushes arrive in bursts, one per pull that finds new ads, so keep
+        # idle connections to push services open longer than aiohttp's
+        # default of 15 seconds to reuse them across nearby bursts.
+        # Most subscriptions share a few push service hosts, so cap the
+        # connections per host and cache their DNS lookups for longer.
+        connector = aiohttp.TCPConnector(
+            keepalive_timeout=60,
+            limit=64,
+            limit_per_host=32,
+            ttl_dns_cache=300,
+        )
+        async with aiohttp.ClientSession(connector=connector) as session:
+            yield cls(vapid_sub=vapid_sub, session=session)
 
     async def notify(self, info: ClientPushInfo, message: str):
-        await asyncio.get_running_loop().run_in_executor(
-            self.executor,
-            lambda: send_webpush(
-                json.loads(info.push_sub),
-                data=message,
-                vapid_private_key=Vapid.from_pem(info.vapid_priv),
-                vapid_claims={"sub": self.vapid_sub},
-            ),
+        # This mirrors pywebpush.webpush(), but sends the request on our own
+        # event loop rather than blocking a thread on requests.
+        sub = orjson.loads(info.push_sub)
+        endpoint = sub["endpoint"]
+        url = urlparse(endpoint)
+        headers = dict(
+            vapid_headers(
+                info.vapid_priv,
+                sub=self.vapid_sub,
+                aud=f"{url.scheme}://{url.netloc}",
+                window=int(time.time()) // VAPID_WINDOW,
+            )
         )
+        headers["Content-Encoding"] = "aes128gcm"
+        headers["TTL"] = "0"
+        body = WebPusher(sub).encode(message, content_encoding="aes128gcm")["body"]
+        async with self.session.post(endpoint, data=body, headers=headers) as resp:
+            if resp.status != 201:
+                raise RuntimeError(f"unexpected status code: {resp.status}")
+
+
+@lru_cache(maxsize=1024)
+def load_vapid(private_pem: bytes) -> Vapid:
+    # Parsing the PEM is relatively expensive, and the same client is usually
+    # notified many times with the same key.
+    return Vapid.from_pem(private_pem)
 
 
-def send_webpush(*args, **kwargs):
-    code = webpush(*args, **kwargs).status_code
-    if code != 201:
-        raise RuntimeError(f"unexpected status code: {code}")
+@lru_cache(maxsize=1024)
+def vapid_headers(
+    private_pem: bytes, sub: str, aud: str, window: int
+) -> Dict[str, str]:
+    # Signing is an ECDSA operation, so sign once per window for each client
+    # and push service rather than once per notification.
+    return load_vapid(private_pem).sign(
+        {"sub": sub, "aud": aud, "exp": (window + 2) * VAPID_WINDOW}
+    )
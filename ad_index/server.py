@@ -1,25 +1,81 @@
 import asyncio
+import gzip
+import hashlib
 import io
-import json
 import logging
+import multiprocessing
 import os
+import re
 import sqlite3
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
+import orjson
 from aiohttp import web
 from aiohttp.web import Request, UrlDispatcher
 from cryptography.hazmat.primitives import serialization
-from jsonschema import validate
+from jsonschema import Draft7Validator
 from jsonschema.exceptions import ValidationError
+from PIL import Image
 from py_vapid import Vapid
 from py_vapid.utils import b64urlencode
 
 from .client import Client
-from .db import DB, AdQuery, AdQueryFilters, AdQueryResult, hash_session_id
+from .db import (
+    DB,
+    AdQuery,
+    AdQueryResult,
+    PushQueueItem,
+    parse_filters,
+)
 from .notifier import Notifier
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of push queue items to claim per DB query.
+PUSH_BATCH_SIZE = 64
+
+# Maximum number of push notifications to send concurrently.
+PUSH_CONCURRENCY = 32
+
+PUSH_SUB_VALIDATOR = Draft7Validator(
+    {
+        "type": "object",
+        "properties": {
+            "endpoint": {"type": "string"},
+            "keys": {
+                "type": "object",
+                "properties": {
+                    "auth": {"type": "string"},
+                    "p256dh": {"type": "string"},
+                },
+                "required": ["auth", "p256dh"],
+            },
+        },
+        "required": ["endpoint", "keys"],
+    }
+)
+
+# Number of pre-generated session keys to keep on hand.
+SESSION_POOL_SIZE = 32
+SESSION_WORKERS = 2
+
+# Seconds create_session waits for keys before giving up.
+SESSION_POOL_TIMEOUT = 10.0
+
+# New session ids are 16-byte BLAKE2b digests; older ones are SHA-256.
+SESSION_ID_RE = re.compile("[0-9a-f]{32}|[0-9a-f]{64}")
+
+# Smaller responses and assets aren't worth compressing.
+MIN_COMPRESS_SIZE = 1024
+COMPRESSED_ASSET_EXTS = (".css", ".html", ".js", ".json", ".svg")
+
+# Screenshots are shown at most 290px wide, so this leaves room for 2x
+# displays without limiting the height of tall ads.
+MAX_SCREENSHOT_SIZE = (600, 3000)
+
 
 class APIError(Exception):
     pass
@@ -31,19 +87,32 @@ def api_method(
     async def _fn(*args) -> web.Response:
         try:
             data = await fn(*args)
+        except APIError as exc:
+            # Bad client input is expected, so skip formatting a traceback.
+            logger.info("API %s returned error: %s", fn.__name__, exc)
+            return json_response(dict(error=str(exc)))
         except Exception as exc:
             logger.exception("error in API handler")
-            return web.json_response(data=dict(error=str(exc)))
+            return json_response(dict(error=str(exc)))
         logger.info(
             "API %s successfully returned object of type %s",
             fn.__name__,
             type(data).__name__,
         )
-        return web.json_response(data=dict(data=data))
+        return json_response(dict(data=data))
 
     return _fn
 
 
+def json_response(data: Any) -> web.Response:
+    body = orjson.dumps(data)
+    response = web.Response(body=body, content_type="application/json")
+    if len(body) >= MIN_COMPRESS_SIZE:
+        # Only applied if the request's Accept-Encoding allows it.
+        response.enable_compression()
+    return response
+
+
 def rewrite_db_errors(
     fn: Callable[..., Awaitable[Any]]
 ) -> Callable[..., Awaitable[web.Response]]:
@@ -65,7 +134,7 @@ class Server:
         *,
         asset_dir: str,
         db: DB,
-        client: Client,
+        clients: Sequence[Client],
         notifier: Notifier,
         max_message_retries: int,
         message_retry_interval: int,
@@ -77,7 +146,7 @@ class Server:
     ):
         self.asset_dir = asset_dir
         self.db = db
-        self.client = client
+        self.clients = clients
         self.notifier = notifier
         self.max_message_retries = max_message_retries
         self.message_retry_interval = message_retry_interval
@@ -86,8 +155,36 @@ class Server:
         self.min_notify_interval = min_notify_interval
         self.max_ad_history = max_ad_history
         self.session_expiration = session_expiration
-        asyncio.create_task(self._push_queue_loop())
-        asyncio.create_task(self._query_loop())
+        self.jpeg_executor = ThreadPoolExecutor(os.cpu_count())
+        with open(os.path.join(asset_dir, "index.html"), "rb") as f:
+            self.index_html = f.read()
+        self.index_etag = '"' + hashlib.sha1(self.index_html).hexdigest() + '"'
+        precompress_assets(asset_dir)
+        self.session_pool = asyncio.Queue(maxsize=SESSION_POOL_SIZE)
+        self.push_semaphore = asyncio.Semaphore(PUSH_CONCURRENCY)
+        self.session_executor = create_session_executor()
+        # Keep references to background tasks, since the event loop only
+        # holds weak ones, and so that close() can stop them.
+        self.tasks: List[asyncio.Task] = []
+        self._start_task(self._push_queue_loop())
+        # Each client drives its own browser, so pulls can run in parallel.
+        for client in clients:
+            self._start_task(self._query_loop(client))
+        self._start_task(self._cleanup_loop())
+        for _ in range(SESSION_WORKERS):
+            self._start_task(self._session_pool_loop())
+
+    def _start_task(self, coro: Awaitable[None]):
+        task = asyncio.create_task(coro)
+        task.add_done_callback(log_task_exit)
+        self.tasks.append(task)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.jpeg_executor.shutdown(cancel_futures=True)
+        self.session_executor.shutdown(cancel_futures=True)
 
     def add_routes(self, router: UrlDispatcher):
         router.add_get("/", self.index)
@@ -108,18 +205,23 @@ class Server:
         )
         router.add_static("/", self.asset_dir)
 
-    async def index(self, _request: Request):
-        return web.FileResponse(os.path.join(self.asset_dir, "index.html"))
+    async def index(self, request: Request):
+        # Browsers revalidate on every load, which costs a 304 at most.
+        headers = {"Cache-Control": "no-cache", "ETag": self.index_etag}
+        if request.headers.get("If-None-Match") == self.index_etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(
+            body=self.index_html, content_type="text/html", headers=headers
+        )
 
     @api_method
     async def api_create_session(self, _request: Request):
-        vapid = Vapid()
-        vapid.generate_keys()
-        vapid_pub = vapid.public_key.public_bytes(
-            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
-        )
-        vapid_priv = vapid.private_pem()
-        session_id = hash_session_id(vapid_pub + vapid_priv)
+        try:
+            vapid_pub, vapid_priv, session_id, response = await asyncio.wait_for(
+                self.session_pool.get(), SESSION_POOL_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            raise APIError("timed out waiting for session keys")
         try:
             await self.db.cleanup_sessions(expiration_time=self.session_expiration)
             await self.db.create_session(
@@ -128,41 +230,26 @@ class Server:
             logger.info("created session with id %s", session_id)
         except Exception as exc:
             raise APIError("Unable to create session in database") from exc
-        return dict(
-            sessionId=session_id,
-            vapidPub=b64urlencode(vapid_pub),
-        )
+        return orjson.Fragment(response)
 
     @api_method
     async def api_session_exists(self, request: Request):
-        session_id = request.query.getone("session_id")
+        session_id = parse_session_id(request.query.getone("session_id"))
         return await self.db.session_exists(session_id)
 
     @api_method
     async def api_update_push_sub(self, request: Request):
-        session_id = request.query.getone("session_id")
-        push_sub = request.query.getone("push_sub") or None
+        q = request.query
+        session_id = parse_session_id(q["session_id"])
+        push_sub = q["push_sub"] or None
         if push_sub is not None:
             try:
-                obj = json.loads(push_sub)
-                if obj is not None:
-                    schema = {
-                        "type": "object",
-                        "properties": {
-                            "endpoint": {"type": "string"},
-                            "keys": {
-                                "type": "object",
-                                "keys": {
-                                    "auth": {"type": "string"},
-                                    "p256dh": {"type": "string"},
-                                },
-                                "required": ["auth", "p256dh"],
-                            },
-                        },
-                        "required": ["endpoint", "keys"],
-                    }
-                    validate(instance=obj, schema=schema)
-            except (json.JSONDecodeError, ValidationError) as exc:
+                obj = orjson.loads(push_sub)
+                if obj is None:
+                    push_sub = None
+                else:
+                    PUSH_SUB_VALIDATOR.validate(obj)
+            except (ValueError, ValidationError) as exc:
                 raise APIError(f"push_sub is not valid JSON: {str(exc)}")
         found = await self.db.update_client_push_sub(
             session_id=session_id, push_sub=push_sub
@@ -172,21 +259,19 @@ class Server:
             raise APIError("session_id not found")
 
     @api_method
-    async def api_get_ad_queries(self, request: Request) -> List[Dict[str, Any]]:
-        session_id = request.query.getone("session_id")
-        results = []
-        for item in await self.db.ad_queries(session_id):
-            results.append(item.to_json())
-        return results
+    async def api_get_ad_queries(self, request: Request) -> orjson.Fragment:
+        session_id = parse_session_id(request.query.getone("session_id"))
+        return orjson.Fragment(await self.db.ad_queries_json(session_id))
 
     @api_method
     async def api_get_ad_query(self, request: Request) -> Dict[str, Any]:
+        q = request.query
         try:
-            session_id = request.query.getone("session_id")
-            ad_query_id = int(request.query.getone("ad_query_id"))
+            session_id = parse_session_id(q["session_id"])
+            ad_query_id = int(q["ad_query_id"])
         except KeyError as exc:
             raise APIError(f"argument not found: {exc}")
-        except json.JSONDecodeError as exc:
+        except ValueError as exc:
             raise APIError(f"failed to parse argument: {exc}")
         for item in await self.db.ad_queries(session_id, ad_query_id=ad_query_id):
             return item.to_json()
@@ -194,12 +279,13 @@ class Server:
 
     @api_method
     async def api_get_ad_query_status(self, request: Request) -> Dict[str, Any]:
+        q = request.query
         try:
-            session_id = request.query.getone("session_id")
-            ad_query_id = int(request.query.getone("ad_query_id"))
+            session_id = parse_session_id(q["session_id"])
+            ad_query_id = int(q["ad_query_id"])
         except KeyError as exc:
             raise APIError(f"argument not found: {exc}")
-        except json.JSONDecodeError as exc:
+        except ValueError as exc:
             raise APIError(f"failed to parse argument: {exc}")
         item = await self.db.ad_query_status(session_id, ad_query_id)
         if item is None:
@@ -242,10 +328,11 @@ class Server:
 
     @api_method
     async def api_toggle_ad_query_subscription(self, request: Request):
+        q = request.query
         try:
-            session_id = request.query.getone("session_id")
-            ad_query_id = int(request.query.getone("ad_query_id"))
-            subscribed = json.loads(request.query.getone("subscribed"))
+            session_id = parse_session_id(q["session_id"])
+            ad_query_id = int(q["ad_query_id"])
+            subscribed = parse_bool(q["subscribed"])
         except KeyError as exc:
             raise APIError(f"argument not found: {exc}")
         except ValueError as exc:
@@ -267,9 +354,10 @@ class Server:
         return [x.to_json() for x in await self.db.list_ad_content(ad_query_id)]
 
     async def ad_content_screenshot(self, request: Request) -> bool:
+        q = request.query
         try:
-            ad_query_id = int(request.query.getone("ad_query_id"))
-            ad_id = request.query.getone("id")
+            ad_query_id = int(q["ad_query_id"])
+            ad_id = q["id"]
         except ValueError:
             return web.Response(body="400 Bad Request", status=400)
         screenshot = await self.db.ad_content_screenshot(ad_query_id, ad_id)
@@ -277,36 +365,88 @@ class Server:
             return web.Response(body="404 Not Found", status=404)
         return web.Response(body=screenshot, status=200, content_type="image/jpeg")
 
+    async def _session_pool_loop(self):
+        # Keep keys for new sessions generated ahead of time, so that
+        # create_session doesn't have to wait on key generation.
+        loop = asyncio.get_running_loop()
+        while True:
+            executor = self.session_executor
+            try:
+                session = await loop.run_in_executor(executor, generate_session)
+            except BrokenProcessPool:
+                logger.exception("session key workers died")
+                # Both refill tasks see the same broken pool; replace it once.
+                if self.session_executor is executor:
+                    executor.shutdown(wait=False)
+                    self.session_executor = create_session_executor()
+                await asyncio.sleep(1.0)
+                continue
+            except Exception:
+                logger.exception("failed to generate session keys")
+                await asyncio.sleep(1.0)
+                continue
+            await self.session_pool.put(session)
+
     async def _push_queue_loop(self):
         while True:
-            item = await self.db.push_queue_next(
-                retry_timeout=self.message_retry_interval
+            # Clear before reading so that an insert racing with the read
+            # still wakes us up below.
+            self.db.push_queue_event.clear()
+            items = await self.db.push_queue_next_batch(
+                retry_timeout=self.message_retry_interval, limit=PUSH_BATCH_SIZE
             )
-            if item is None:
-                await asyncio.sleep(10.0)
-                continue
-            success = False
-            try:
-                logger.info(
-                    "sending push queue item %d => client %d", item.id, item.client_id
+            if items:
+                # An unexpected error counts as a failed delivery rather than
+                # killing the loop.
+                successes = await asyncio.gather(
+                    *[self._send_push_queue_item(x) for x in items],
+                    return_exceptions=True,
                 )
-                await self.notifier.notify(item.push_info, item.message)
-                success = True
-            except:
-                logger.exception("failed to deliver push queue item")
-            else:
-                logger.info(
-                    "successfully sent push queue item %d => client %d",
-                    item.id,
-                    item.client_id,
+                await self.db.push_queue_finish_batch(
+                    [
+                        (item.id, success is not True)
+                        for item, success in zip(items, successes)
+                        if success is True or item.retries >= self.max_message_retries
+                    ]
                 )
-            if success or item.retries >= self.max_message_retries:
-                await self.db.push_queue_finish(item.id, unsub_client=not success)
-
-    async def _query_loop(self):
-        await self.db.cleanup_ads(
-            max_ads=self.max_ad_history, text_expiration=self.ad_text_expiration
+            if len(items) < PUSH_BATCH_SIZE:
+                # Nothing else is due, so sleep until an insert or until the
+                # next retry comes due, whichever happens first.
+                timeout = self.message_retry_interval
+                retry_time = await self.db.push_queue_next_retry_time()
+                if retry_time is not None:
+                    timeout = min(timeout, max(0, retry_time - time.time()))
+                try:
+                    await asyncio.wait_for(self.db.push_queue_event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send_push_queue_item(self, item: PushQueueItem) -> bool:
+        try:
+            logger.info(
+                "sending push queue item %d => client %d", item.id, item.client_id
+            )
+            async with self.push_semaphore:
+                await self.notifier.notify(item.push_info, item.message)
+        except:
+            logger.exception("failed to deliver push queue item")
+            return False
+        logger.info(
+            "successfully sent push queue item %d => client %d",
+            item.id,
+            item.client_id,
         )
+        return True
+
+    async def _cleanup_loop(self):
+        # Old text hashes expire over time even when nothing new is inserted.
+        while True:
+            await self.db.cleanup_ads(
+                max_ads=self.max_ad_history, text_expiration=self.ad_text_expiration
+            )
+            await asyncio.sleep(max(1, self.ad_text_expiration // 10))
+
+    async def _query_loop(self, client: Client):
         while True:
             query: Optional[AdQuery] = await self.db.ad_query_next(
                 refresh_interval=self.refresh_interval
@@ -320,75 +460,78 @@ class Server:
                 query.query,
                 query.filters,
             )
+            should_keep = query.filters.compile()
             try:
                 results = [
                     result
-                    for result in await self.client.query(query.query)
-                    if query.filters.should_keep(
-                        content=result.text, account_name=result.account_name
-                    )
+                    for result in await client.query(query.query)
+                    if should_keep(result.text, result.account_name)
                 ]
                 new_ids = await self.db.unseen_ad_ids(
                     query.ad_query_id, [x.id for x in results]
                 )
                 logger.info("query returned %d new ids", len(new_ids))
-                screenshots = await self.client.screenshot_ids(list(new_ids))
+                screenshots = await client.screenshot_ids(list(new_ids))
             except Exception as exc:
                 logger.exception("error fetching results")
                 await self.db.ad_query_finished_pull(
                     ad_query_id=query.ad_query_id, error=str(exc)
                 )
                 continue
-            for result in results[::-1]:
-                if result.id not in new_ids:
-                    continue
-                data = io.BytesIO()
-                if result.id in screenshots:
-                    screenshot = screenshots[result.id]
-                    screenshot.convert("RGB").save(data, format="JPEG", quality=85)
-                inserted = await self.db.insert_ad(
-                    ad_query_id=query.ad_query_id,
-                    id=result.id,
-                    account_name=result.account_name,
-                    account_url=result.account_url,
-                    start_date=result.start_date,
-                    text=result.text,
-                    screenshot=data.getvalue(),
-                    text_expiration=self.ad_text_expiration,
-                    min_notify_interval=self.min_notify_interval,
-                )
-                if inserted:
-                    logger.debug(
-                        "inserted ad with id %s into ad query %d",
+            new_results = [x for x in reversed(results) if x.id in new_ids]
+            loop = asyncio.get_running_loop()
+            jpegs = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.jpeg_executor, encode_jpeg, screenshots.get(x.id)
+                    )
+                    for x in new_results
+                ]
+            )
+            inserted = await self.db.insert_ads_batch(
+                ad_query_id=query.ad_query_id,
+                ads=[
+                    (
                         result.id,
-                        query.ad_query_id,
+                        result.account_name,
+                        result.account_url,
+                        result.start_date,
+                        result.text,
+                        jpeg,
                     )
+                    for result, jpeg in zip(new_results, jpegs)
+                ],
+                text_expiration=self.ad_text_expiration,
+                min_notify_interval=self.min_notify_interval,
+            )
+            logger.debug(
+                "inserted %d ads into ad query %d", inserted, query.ad_query_id
+            )
             logger.info("finished pull for ad query %d", query.ad_query_id)
             await self.db.ad_query_finished_pull(ad_query_id=query.ad_query_id)
-            await self.db.cleanup_ads(
-                max_ads=self.max_ad_history, text_expiration=self.ad_text_expiration
-            )
+            if inserted:
+                await self.db.cleanup_ads(
+                    max_ads=self.max_ad_history,
+                    text_expiration=self.ad_text_expiration,
+                )
 
 
 def parse_ad_query_request(request: Request, update: bool) -> Tuple[str, AdQueryResult]:
+    q = request.query
     try:
-        session_id = request.query.getone("session_id")
-        nickname = request.query.getone("nickname")
-        query = request.query.getone("query")
-        filters = AdQueryFilters.from_json(json.loads(request.query.getone("filters")))
-        subscribed = json.loads(request.query.getone("subscribed"))
-        if not isinstance(subscribed, bool):
-            raise APIError("subscribed must be a boolean")
+        session_id = parse_session_id(q["session_id"])
+        nickname = q["nickname"]
+        query = q["query"]
+        filters = parse_filters(q["filters"])
+        subscribed = parse_bool(q["subscribed"])
         if update:
-            ad_query_id = int(request.query.getone("ad_query_id"))
+            ad_query_id = int(q["ad_query_id"])
         else:
             ad_query_id = None
     except KeyError as exc:
         raise APIError(f"argument not found: {exc}")
-    except (json.JSONDecodeError, APIError, ValidationError, ValueError) as exc:
+    except (APIError, ValidationError, ValueError) as exc:
         raise APIError(f"failed to parse argument: {exc}")
-    if not isinstance(subscribed, bool):
-        raise APIError("subscribed must be true or false")
     return (
         session_id,
         AdQueryResult(
@@ -399,3 +542,98 @@ def parse_ad_query_request(request: Request, update: bool) -> Tuple[str, AdQuery
             subscribed=subscribed,
         ),
     )
+
+
+def precompress_assets(asset_dir: str):
+    # aiohttp's static handler serves "foo.js.gz" in place of "foo.js" to
+    # clients that accept gzip whenever it exists, so every ".gz" must match
+    # its source. They are rewritten on each startup rather than trusting
+    # mtimes, which means edits to assets need a server restart.
+    for dir_path, _, file_names in os.walk(asset_dir):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            try:
+                if name.endswith(".gz"):
+                    source_path = path[: -len(".gz")]
+                    if source_path.endswith(COMPRESSED_ASSET_EXTS) and (
+                        not os.path.exists(source_path)
+                    ):
+                        os.remove(path)
+                    continue
+                if not name.endswith(COMPRESSED_ASSET_EXTS):
+                    continue
+                gz_path = path + ".gz"
+                with open(path, "rb") as f:
+                    data = f.read()
+                if len(data) < MIN_COMPRESS_SIZE:
+                    # Don't leave an older compressed copy to be served.
+                    if os.path.exists(gz_path):
+                        os.remove(gz_path)
+                    continue
+                # Write then rename, so a partial file is never served.
+                tmp_path = gz_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(gzip.compress(data, compresslevel=9))
+                os.replace(tmp_path, gz_path)
+            except OSError:
+                logger.exception("failed to precompress asset: %s", path)
+
+
+def create_session_executor() -> ProcessPoolExecutor:
+    # Key generation is CPU-bound and holds the GIL, so use processes.
+    # Spawn rather than fork, since this process already runs threads.
+    return ProcessPoolExecutor(
+        SESSION_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def generate_session() -> Tuple[bytes, bytes, str, bytes]:
+    vapid = Vapid()
+    vapid.generate_keys()
+    vapid_pub = vapid.public_key.public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    vapid_priv = vapid.private_pem()
+    # Session ids only need to be unguessable. The DB stores SHA-256 hashes
+    # of them via hash_session_id(), so existing sessions are unaffected.
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(vapid_pub)
+    hasher.update(vapid_priv)
+    session_id = hasher.hexdigest()
+    # The create_session response is serialized here, off the event loop.
+    response = orjson.dumps(
+        dict(sessionId=session_id, vapidPub=b64urlencode(vapid_pub))
+    )
+    return vapid_pub, vapid_priv, session_id, response
+
+
+def log_task_exit(task: asyncio.Task):
+    # Background loops never return, so anything but cancellation is a bug.
+    if not task.cancelled():
+        logger.error("background task exited", exc_info=task.exception())
+
+
+def parse_session_id(value: str) -> str:
+    # Session ids are hex strings, so reject anything else before it reaches
+    # the DB layer.
+    if not SESSION_ID_RE.fullmatch(value):
+        raise APIError("session_id is not valid")
+    return value
+
+
+def parse_bool(value: str) -> bool:
+    value = value.lower()
+    if value == "true":
+        return True
+    elif value == "false":
+        return False
+    raise ValueError(f"expected true or false but got: {value}")
+
+
+def encode_jpeg(screenshot: Optional[Image.Image]) -> bytes:
+    data = io.BytesIO()
+    if screenshot is not None:
+        screenshot = screenshot.convert("RGB")
+        screenshot.thumbnail(MAX_SCREENSHOT_SIZE, Image.LANCZOS)
+        screenshot.save(data, format="JPEG", quality=75, progressive=True)
+    return data.getvalue()
@@ -3,15 +3,18 @@ from setuptools import setup
 setup(
     name="ad-index",
     packages=["ad_index"],
+    python_requires=">=3.10",
     install_requires=[
         "Pillow==9.0",
         "aiohttp==3.8",
         "aiosqlite==0.19",
         "cryptography==3.4",
         "jsonschema==4.17",
+        "orjson==3.9",
         "py-vapid==1.9",
         "pywebpush==1.14",
         "selenium==4.10",
+        "uvloop==0.19",
     ],
     author="Alex Nichol",
 )